@@ -5,6 +5,7 @@
   - Lit les PDFs du dossier courant
   - Découpe le texte en fragments (chunks)
   - Génère les embeddings avec all-MiniLM-L6-v2
+  - Déduplique les fragments (hash exact + shingles/Jaccard et cosinus)
   - Stocke dans PostgreSQL (vecteur en TEXT JSON)
 =============================================================
 """
@@ -17,6 +18,8 @@ import numpy as np
 from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 
+from deduplication import empreinte, shingles, jaccard, valeurs_numeriques
+
 # Charger les variables d'environnement
 load_dotenv()
 
@@ -27,6 +30,10 @@ PDF_FOLDER = os.path.dirname(os.path.abspath(__file__))
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 50
 MODEL_NAME = "all-MiniLM-L6-v2"
+# Quasi-doublons (adresses, stockage, mentions légales communes aux fiches) :
+# il faut à la fois un cosinus et un Jaccard de shingles élevés
+SEUIL_COSINUS = float(os.getenv("SEUIL_COSINUS", "0.95"))
+SEUIL_JACCARD = float(os.getenv("SEUIL_JACCARD", "0.95"))
 
 DB_CONFIG = {
     "host":     os.getenv("DB_HOST", "localhost"),
@@ -67,6 +74,78 @@ def decouper_en_chunks(texte: str, taille: int = CHUNK_SIZE, overlap: int = CHUN
     return chunks
 
 
+class IndexDedupliquee:
+    """
+    Accumule les fragments uniques de tous les documents.
+    Un fragment déjà vu n'est pas stocké à nouveau : on ajoute seulement le
+    document à sa liste de sources. Doublon = même hash, ou quasi-doublon :
+    cosinus >= SEUIL_COSINUS, Jaccard des shingles >= SEUIL_JACCARD et
+    mêmes valeurs numériques (deux fiches sœurs comme L MAX63 / L MAX64,
+    qui ne diffèrent que par les dosages ou la référence, restent distinctes).
+    """
+
+    def __init__(self, seuil_cosinus: float = SEUIL_COSINUS, seuil_jaccard: float = SEUIL_JACCARD):
+        self.seuil_cosinus = seuil_cosinus
+        self.seuil_jaccard = seuil_jaccard
+        self.fragments = []
+        self.sources = []
+        self.shingles = []
+        self.nombres = []
+        self.matrice = None  # vecteurs des fragments retenus, empilés après chaque document
+        self.hashes = {}
+        self.doublons_exacts = 0
+        self.quasi_doublons = 0
+
+    def _chercher_quasi_doublon(self, fragment: str, vecteur: np.ndarray, nouveaux: list):
+        # Vecteurs normalisés : produit scalaire = cosinus. Les lignes de la
+        # matrice puis les nouveaux vecteurs suivent l'ordre de self.fragments.
+        sims = []
+        if self.matrice is not None:
+            sims.append(self.matrice @ vecteur)
+        if nouveaux:
+            sims.append(np.asarray(nouveaux) @ vecteur)
+        if not sims:
+            return None
+        sims = np.concatenate(sims)
+
+        candidats = np.flatnonzero(sims >= self.seuil_cosinus)
+        if len(candidats) == 0:
+            return None
+        sh = shingles(fragment)
+        nb = valeurs_numeriques(fragment)
+        for idx in candidats[np.argsort(sims[candidats])[::-1]]:
+            if self.nombres[idx] == nb and jaccard(sh, self.shingles[idx]) >= self.seuil_jaccard:
+                return int(idx)
+        return None
+
+    def ajouter(self, id_document: int, fragments: list[str], vecteurs: np.ndarray):
+        nouveaux = []
+        for fragment, vecteur in zip(fragments, vecteurs):
+            h = empreinte(fragment)
+            idx = self.hashes.get(h)
+            if idx is not None:
+                self.doublons_exacts += 1
+            else:
+                idx = self._chercher_quasi_doublon(fragment, vecteur, nouveaux)
+                if idx is not None:
+                    self.quasi_doublons += 1
+
+            if idx is None:
+                idx = len(self.fragments)
+                self.fragments.append(fragment)
+                self.sources.append([id_document])
+                self.shingles.append(shingles(fragment))
+                self.nombres.append(valeurs_numeriques(fragment))
+                nouveaux.append(vecteur)
+            elif id_document not in self.sources[idx]:
+                self.sources[idx].append(id_document)
+            self.hashes[h] = idx
+
+        if nouveaux:
+            bloc = np.asarray(nouveaux, dtype=np.float32)
+            self.matrice = bloc if self.matrice is None else np.vstack([self.matrice, bloc])
+
+
 def connecter_bd():
     """Établit une connexion à PostgreSQL."""
     return psycopg2.connect(**DB_CONFIG)
@@ -79,8 +158,10 @@ def creer_table(conn):
         id             SERIAL PRIMARY KEY,
         id_document    INT,
         texte_fragment TEXT,
-        vecteur        TEXT
+        vecteur        TEXT,
+        documents      TEXT
     );
+    ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS documents TEXT;
     """
     with conn.cursor() as cur:
         cur.execute(sql)
@@ -88,17 +169,24 @@ def creer_table(conn):
     print("✅ Table 'embeddings' prête.")
 
 
-def inserer_fragments(conn, id_document: int, fragments: list[str], vecteurs: np.ndarray):
-    """Insère les fragments et leurs vecteurs (en JSON) dans la base."""
+def inserer_fragments(conn, index: IndexDedupliquee):
+    """
+    Remplace le contenu de la table par les fragments uniques, chacun avec
+    son vecteur et la liste de ses documents sources (en JSON).
+    id_document = première source. Vider la table évite qu'une nouvelle
+    ingestion ne réinsère les mêmes fragments.
+    """
     sql = """
-        INSERT INTO embeddings (id_document, texte_fragment, vecteur)
-        VALUES (%s, %s, %s)
+        INSERT INTO embeddings (id_document, texte_fragment, vecteur, documents)
+        VALUES (%s, %s, %s, %s)
     """
     with conn.cursor() as cur:
-        for fragment, vecteur in zip(fragments, vecteurs):
+        cur.execute("TRUNCATE embeddings RESTART IDENTITY;")
+        vecteurs = index.matrice if index.matrice is not None else []
+        for fragment, vecteur, sources in zip(index.fragments, vecteurs, index.sources):
             # Convertir le vecteur numpy en JSON string
             vecteur_json = json.dumps(vecteur.tolist())
-            cur.execute(sql, (id_document, fragment, vecteur_json))
+            cur.execute(sql, (sources[0], fragment, vecteur_json, json.dumps(sources)))
     conn.commit()
 
 
@@ -130,6 +218,7 @@ def main():
     print(f"\n📂 {len(pdfs)} PDFs trouvés dans le dossier.\n")
 
     total_chunks = 0
+    index = IndexDedupliquee()
 
     for id_doc, nom_pdf in enumerate(pdfs, start=1):
         chemin = os.path.join(PDF_FOLDER, nom_pdf)
@@ -146,14 +235,28 @@ def main():
         vecteurs = modele.encode(chunks, show_progress_bar=False, normalize_embeddings=True)
         print(f"    🔢 {len(vecteurs)} vecteurs (dim=384)")
 
-        inserer_fragments(conn, id_doc, chunks, vecteurs)
-        print(f"    💾 Inséré en base.")
+        avant = len(index.fragments)
+        index.ajouter(id_doc, chunks, vecteurs)
+        print(f"    🧹 {len(index.fragments) - avant} fragments nouveaux")
 
         total_chunks += len(chunks)
 
+    print(
+        f"\n🧹 Déduplication : {index.doublons_exacts} doublons exacts, "
+        f"{index.quasi_doublons} quasi-doublons (cosinus >= {index.seuil_cosinus}, "
+        f"Jaccard >= {index.seuil_jaccard})"
+    )
+    if not index.fragments:
+        # Aucun texte lu (dossier vide, PyMuPDF en panne...) : on garde l'index existant
+        print("⚠ Aucun fragment extrait : la table 'embeddings' n'est pas modifiée.")
+        conn.close()
+        return
+    inserer_fragments(conn, index)
+    print(f"💾 {len(index.fragments)} fragments uniques insérés en base.")
+
     conn.close()
     print("\n" + "=" * 60)
-    print(f"✅ INGESTION TERMINÉE : {total_chunks} fragments au total")
+    print(f"✅ INGESTION TERMINÉE : {total_chunks} fragments lus, {len(index.fragments)} uniques")
     print("=" * 60)
 
 
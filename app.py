@@ -12,13 +12,18 @@ import time
 import re
 import csv
 import io
+import atexit
+import threading
+from collections import Counter
 import psycopg2
 import numpy as np
-from flask import Flask, render_template, request, jsonify, Response, send_from_directory
+from flask import Flask, render_template, request, jsonify, Response, send_from_directory, stream_with_context
 from sentence_transformers import SentenceTransformer
 from sklearn.metrics.pairwise import cosine_similarity
 from dotenv import load_dotenv
 
+from deduplication import normaliser_texte, shingles, jaccard
+
 load_dotenv()
 
 app = Flask(__name__)
@@ -36,14 +41,54 @@ DB_CONFIG = {
 
 PDF_FOLDER = os.path.dirname(os.path.abspath(__file__))
 
+# Prechauffage au demarrage : questions passees (historique persiste) ou,
+# a defaut, exemples de RESULTATS_ATTENDUS.md
+HISTORIQUE_PATH = os.getenv("HISTORIQUE_PATH", os.path.join(PDF_FOLDER, "historique.json"))
+RESULTATS_ATTENDUS_PATH = os.path.join(PDF_FOLDER, "RESULTATS_ATTENDUS.md")
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") != "0"
+WARMUP_TOP_N = int(os.getenv("WARMUP_TOP_N", "10"))
+# Base pas encore joignable au demarrage : nouvelles tentatives (1 s, 2 s, 4 s...)
+WARMUP_TENTATIVES = int(os.getenv("WARMUP_TENTATIVES", "6"))
+CACHE_MAX = 256
+COMPTEUR_MAX = 1000
+# L'historique est ecrit sur disque toutes les N recherches (et a l'arret)
+HISTORIQUE_SAUVEGARDE_TOUTES = 20
+
+# Fusion a la recherche des fenetres decalees d'un meme passage commun
+# (adresses, stockage, mentions legales). Mesure sur les 35 fiches : ces
+# fenetres ont un Jaccard de 0.6 a 1, les fragments propres a des fiches
+# soeurs (L MAX63/64, HCF500/600...) ne depassent pas 0.61.
+SEUIL_JACCARD_RECHERCHE = float(os.getenv("SEUIL_JACCARD_RECHERCHE", "0.7"))
+
+# Export serveur en flux : nombre de resultats par question par defaut
+EXPORT_TOP_K = int(os.getenv("EXPORT_TOP_K", "1000"))
+
 print(f"Chargement du modele '{MODEL_NAME}'...")
 modele = SentenceTransformer(MODEL_NAME)
 print("Modele pret.")
 
-_cache = {"ids": None, "fragments": None, "vecteurs": None, "doc_ids": None}
+_cache = {"ids": None, "fragments": None, "vecteurs": None, "doc_ids": None, "sources": None}
+_cache_requetes = {}   # question -> embedding normalise
+_cache_resultats = {}  # (question, top_k) -> resultat de recherche_semantique
+_warmup = {
+    "pret":                             False,
+    "questions":                        0,
+    "duree_ms":                         None,
+    "premiere_requete_prechauffage_ms": None,  # requete a froid, pendant le prechauffage
+    "premiere_requete_ms":              None,  # premiere /recherche servie apres
+}
 historique = []
+compteur_questions = Counter()  # toutes les questions posees, pour le prechauffage
+_recherches_non_sauvegardees = 0
 doc_names = {}
 
+# Le serveur Flask est multi-thread et le prechauffage tourne en arriere-plan
+_verrou_index = threading.Lock()
+_verrou_caches = threading.Lock()
+_verrou_historique = threading.Lock()
+_verrou_fichier = threading.Lock()
+_verrou_warmup = threading.Lock()
+
 
 def connecter_bd():
     return psycopg2.connect(**DB_CONFIG)
@@ -59,34 +104,125 @@ def charger_doc_names():
     return doc_names
 
 
+def charger_historique():
+    if not os.path.exists(HISTORIQUE_PATH):
+        return
+    try:
+        with open(HISTORIQUE_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Historique illisible ({e}), ignore.")
+        return
+    if isinstance(data, list):  # ancien format : historique seul
+        data = {"historique": data}
+    historique.extend(data.get("historique", []))
+    compteur_questions.update(data.get("compteur", {}))
+
+
+def _instantane_historique():
+    """Copie serialisable de l'historique ; appeler avec _verrou_historique."""
+    return {"historique": list(historique), "compteur": dict(compteur_questions)}
+
+
+def ecrire_historique(instantane):
+    """Ecrit dans un fichier temporaire puis le renomme : jamais de fichier tronque."""
+    tmp = HISTORIQUE_PATH + ".tmp"
+    with _verrou_fichier:
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(instantane, f, ensure_ascii=False)
+            os.replace(tmp, HISTORIQUE_PATH)
+        except OSError as e:
+            print(f"Sauvegarde de l'historique impossible : {e}")
+
+
+def sauvegarder_historique():
+    global _recherches_non_sauvegardees
+    with _verrou_historique:
+        if not _recherches_non_sauvegardees:
+            return
+        instantane = _instantane_historique()
+        _recherches_non_sauvegardees = 0
+    ecrire_historique(instantane)
+
+
+def ajouter_historique(entree):
+    """
+    Met a jour l'historique en memoire ; le disque n'est ecrit que toutes
+    les HISTORIQUE_SAUVEGARDE_TOUTES recherches, hors du verrou.
+    """
+    global _recherches_non_sauvegardees
+    instantane = None
+    with _verrou_historique:
+        historique.insert(0, entree)
+        if len(historique) > 30:
+            historique.pop()
+        compteur_questions[entree["question"]] += 1
+        if len(compteur_questions) > COMPTEUR_MAX:
+            garder = compteur_questions.most_common(COMPTEUR_MAX // 2)
+            compteur_questions.clear()
+            compteur_questions.update(dict(garder))
+        _recherches_non_sauvegardees += 1
+        if _recherches_non_sauvegardees >= HISTORIQUE_SAUVEGARDE_TOUTES:
+            instantane = _instantane_historique()
+            _recherches_non_sauvegardees = 0
+    if instantane is not None:
+        ecrire_historique(instantane)
+
+
+def memoriser(cache, cle, valeur):
+    """Ajoute au cache borne (CACHE_MAX), en evincant l'entree la plus ancienne."""
+    with _verrou_caches:
+        if cle not in cache and len(cache) >= CACHE_MAX:
+            cache.pop(next(iter(cache)), None)
+        cache[cle] = valeur
+
+
 def charger_embeddings():
+    with _verrou_index:
+        return _charger_embeddings()
+
+
+def _charger_embeddings():
     if _cache["ids"] is not None:
-        return _cache["ids"], _cache["fragments"], _cache["vecteurs"], _cache["doc_ids"]
+        return _cache["ids"], _cache["fragments"], _cache["vecteurs"], _cache["doc_ids"], _cache["sources"]
 
     conn = connecter_bd()
-    sql = "SELECT id, id_document, texte_fragment, vecteur FROM embeddings;"
+    sql = "SELECT id, id_document, texte_fragment, vecteur, documents FROM embeddings;"
     with conn.cursor() as cur:
         cur.execute(sql)
         rows = cur.fetchall()
     conn.close()
 
     if not rows:
-        return [], [], np.array([]), []
+        return [], [], np.array([]), [], []
 
-    ids, doc_ids, fragments, vecteurs = [], [], [], []
+    ids, doc_ids, fragments, vecteurs, sources = [], [], [], [], []
+    positions = {}  # texte normalise -> position, pour fusionner les doublons
     for row in rows:
-        id_, doc_id, texte, vecteur_json = row
+        id_, doc_id, texte, vecteur_json, documents_json = row
+        # Fragment deduplique : tous ses documents sources (index ancien : un seul)
+        docs = json.loads(documents_json) if documents_json else [doc_id]
+        cle = normaliser_texte(texte)
+        if cle in positions:
+            # Index construit avant la deduplication : meme texte, une seule entree
+            deja = sources[positions[cle]]
+            deja.extend(d for d in docs if d not in deja)
+            continue
+        positions[cle] = len(ids)
         ids.append(id_)
         doc_ids.append(doc_id)
         fragments.append(texte)
         vecteurs.append(json.loads(vecteur_json))
+        sources.append(docs)
 
     _cache["ids"] = ids
     _cache["doc_ids"] = doc_ids
     _cache["fragments"] = fragments
     _cache["vecteurs"] = np.array(vecteurs, dtype=np.float32)
+    _cache["sources"] = sources
 
-    return ids, fragments, _cache["vecteurs"], doc_ids
+    return ids, fragments, _cache["vecteurs"], doc_ids, sources
 
 
 def extraire_mots_cles(question, texte):
@@ -217,21 +353,63 @@ def analyser_qualite(scores_top, question, resultats):
         }
 
 
+def encoder_question(question):
+    embedding = _cache_requetes.get(question)
+    if embedding is None:
+        embedding = modele.encode([question], normalize_embeddings=True)
+        memoriser(_cache_requetes, question, embedding)
+    return embedding
+
+
+def calculer_scores(question):
+    _, _, matrice_vect, _, _ = charger_embeddings()
+    return cosine_similarity(encoder_question(question), matrice_vect)[0]
+
+
+def regrouper_doublons(indices_tries, fragments, sources, top_k, seuil=SEUIL_JACCARD_RECHERCHE):
+    """
+    Parcourt les fragments par score decroissant et garde jusqu'a top_k
+    representants. Un fragment trop proche (Jaccard des shingles >= seuil)
+    d'un representant deja retenu est saute : ses documents s'ajoutent a
+    ceux du representant. Renvoie [(idx, ids_documents), ...].
+    """
+    groupes = []  # [idx, shingles, ids_documents]
+    for idx in indices_tries:
+        sh = shingles(fragments[idx])
+        for groupe in groupes:
+            if jaccard(sh, groupe[1]) >= seuil:
+                groupe[2].extend(d for d in sources[idx] if d not in groupe[2])
+                break
+        else:
+            if len(groupes) >= top_k:
+                break
+            groupes.append([idx, sh, list(sources[idx])])
+    return [(idx, docs) for idx, _, docs in groupes]
+
+
 def recherche_semantique(question: str, top_k: int = TOP_K) -> dict:
     debut = time.time()
 
-    embedding_question = modele.encode([question], normalize_embeddings=True)
-    ids, fragments, matrice_vect, doc_ids = charger_embeddings()
+    cle = (question, top_k)
+    en_cache = _cache_resultats.get(cle)
+    if en_cache is not None:
+        resultat = dict(en_cache)
+        resultat["temps_ms"] = round((time.time() - debut) * 1000, 1)
+        resultat["cache"] = True
+        return resultat
+
+    ids, fragments, matrice_vect, doc_ids, sources = charger_embeddings()
 
     if len(fragments) == 0:
         return {"resultats": [], "temps_ms": 0, "total_fragments": 0}
 
-    scores = cosine_similarity(embedding_question, matrice_vect)[0]
+    scores = calculer_scores(question)
     indices_tries = np.argsort(scores)[::-1]
 
     doc_name_map = charger_doc_names()
     resultats = []
-    for rang, idx in enumerate(indices_tries[:top_k], start=1):
+    groupes = regrouper_doublons(indices_tries, fragments, sources, top_k)
+    for rang, (idx, docs) in enumerate(groupes, start=1):
         texte_nettoye = nettoyer_texte(fragments[idx])
         mots_cles = extraire_mots_cles(question, texte_nettoye)
         doc_id = doc_ids[idx]
@@ -243,6 +421,7 @@ def recherche_semantique(question: str, top_k: int = TOP_K) -> dict:
             "mots_cles":   mots_cles,
             "document":    doc_name_map.get(doc_id, f"Document {doc_id}"),
             "id_document": doc_id,
+            "documents":   [doc_name_map.get(d, f"Document {d}") for d in docs],
         })
 
     temps_ms = round((time.time() - debut) * 1000, 1)
@@ -253,13 +432,67 @@ def recherche_semantique(question: str, top_k: int = TOP_K) -> dict:
         resultats
     )
 
-    return {
+    resultat = {
         "resultats":       resultats,
         "temps_ms":        temps_ms,
         "total_fragments": len(fragments),
         "score_moyen":     round(float(np.mean(scores)), 4),
         "qualite":         qualite,
     }
+    memoriser(_cache_resultats, cle, resultat)
+    return resultat
+
+
+def questions_prechauffage(n: int = WARMUP_TOP_N) -> list[str]:
+    """
+    Questions a rejouer au demarrage : les plus frequentes de toutes celles
+    posees (compteur persiste), completees par les exemples de
+    RESULTATS_ATTENDUS.md.
+    """
+    with _verrou_historique:
+        questions = [q for q, _ in compteur_questions.most_common(n)]
+
+    if len(questions) < n and os.path.exists(RESULTATS_ATTENDUS_PATH):
+        with open(RESULTATS_ATTENDUS_PATH, encoding="utf-8") as f:
+            exemples = re.findall(r'\*"([^"]+)"\*', f.read())
+        for q in exemples:
+            if q not in questions:
+                questions.append(q)
+
+    return questions[:n]
+
+
+def prechauffer():
+    """
+    Charge l'index, initialise BLAS et le modele, puis remplit les caches
+    de requetes et de resultats. /sante repond 503 tant que ce n'est pas fini.
+    """
+    debut = time.time()
+    charger_doc_names()
+    charger_embeddings()
+
+    questions = questions_prechauffage()
+    for i, question in enumerate(questions):
+        t0 = time.time()
+        recherche_semantique(question)
+        if i == 0:
+            _warmup["premiere_requete_prechauffage_ms"] = round((time.time() - t0) * 1000, 1)
+
+    _warmup["questions"] = len(questions)
+    _warmup["duree_ms"] = round((time.time() - debut) * 1000, 1)
+    _warmup["pret"] = True
+    print(
+        f"Prechauffage termine : {len(questions)} questions en {_warmup['duree_ms']} ms "
+        f"(premiere requete : {_warmup['premiere_requete_prechauffage_ms']} ms)."
+    )
+
+
+def noter_premiere_requete(temps_ms):
+    """Latence de la premiere /recherche servie une fois l'instance prete."""
+    with _verrou_warmup:
+        if _warmup["pret"] and _warmup["premiere_requete_ms"] is None:
+            _warmup["premiere_requete_ms"] = temps_ms
+            print(f"Premiere requete apres demarrage : {temps_ms} ms.")
 
 
 def get_stats():
@@ -267,7 +500,12 @@ def get_stats():
     with conn.cursor() as cur:
         cur.execute("SELECT COUNT(*) FROM embeddings;")
         total = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(DISTINCT id_document) FROM embeddings;")
+        # Toutes les sources des fragments dedupliques (id_document pour les anciennes lignes)
+        cur.execute("""
+            SELECT COUNT(DISTINCT d)
+            FROM embeddings,
+                 json_array_elements_text(COALESCE(documents::json, json_build_array(id_document))) AS d;
+        """)
         docs = cur.fetchone()[0]
         cur.execute("SELECT AVG(LENGTH(texte_fragment)) FROM embeddings;")
         avg_len = cur.fetchone()[0]
@@ -279,6 +517,91 @@ def get_stats():
     }
 
 
+def generer_lignes_export(index, questions, top_k):
+    """
+    Pour chaque question, classe tous les fragments et produit une ligne
+    par resultat (Top-K), doublons regroupes. Les textes viennent de l'index
+    deja en memoire (charge par la route avant de commencer la reponse) ;
+    par question, seuls les Top-K representants et leurs shingles sont gardes.
+    """
+    ids, fragments, _, doc_ids, sources = index
+    if not ids:
+        return
+    doc_name_map = charger_doc_names()
+    top_k = min(top_k, len(ids))
+
+    for question in questions:
+        scores = calculer_scores(question)
+        indices_tries = np.argsort(scores)[::-1]
+        groupes = regrouper_doublons(indices_tries, fragments, sources, top_k)
+
+        for rang, (idx, docs) in enumerate(groupes, start=1):
+            texte_nettoye = nettoyer_texte(fragments[idx])
+            doc_id = doc_ids[idx]
+            yield {
+                "question":    question,
+                "rang":        rang,
+                "score":       round(float(scores[idx]), 4),
+                "id":          ids[idx],
+                "document":    doc_name_map.get(doc_id, f"Document {doc_id}"),
+                "id_document": doc_id,
+                "documents":   [doc_name_map.get(d, f"Document {d}") for d in docs],
+                "texte":       texte_nettoye,
+                "mots_cles":   extraire_mots_cles(question, texte_nettoye),
+            }
+
+
+def lire_parametres_export():
+    """
+    Questions (liste de chaines) et top_k (entier >= 1), depuis le JSON
+    ou la query string. Renvoie (questions, top_k, erreur).
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return None, None, "Corps JSON invalide"
+
+    if "questions" in data:
+        questions = data["questions"]
+    elif "question" in data:
+        questions = [data["question"]]
+    else:
+        questions = request.args.getlist("question")
+    if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+        return None, None, "'questions' doit etre une liste de chaines"
+    questions = [q.strip() for q in questions if q.strip()]
+    if not questions:
+        return None, None, "Question vide"
+
+    top_k = data.get("top_k", request.args.get("top_k", EXPORT_TOP_K))
+    if isinstance(top_k, str):
+        try:
+            top_k = int(top_k)
+        except ValueError:
+            return None, None, "'top_k' doit etre un entier >= 1"
+    if isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1:
+        return None, None, "'top_k' doit etre un entier >= 1"
+
+    return questions, top_k, None
+
+
+def preparer_export():
+    """
+    Valide les parametres et charge l'index avant de commencer le flux,
+    pour qu'une erreur donne une reponse JSON et non un export tronque.
+    Renvoie (questions, top_k, index, reponse_erreur).
+    """
+    questions, top_k, erreur = lire_parametres_export()
+    if erreur:
+        return None, None, None, (jsonify({"erreur": erreur}), 400)
+    try:
+        index = charger_embeddings()
+    except Exception as e:
+        return None, None, None, (jsonify({"erreur": str(e)}), 500)
+    return questions, top_k, index, None
+
+
 # ── ROUTES ──
 
 @app.route("/")
@@ -298,13 +621,12 @@ def recherche():
 
     try:
         resultat = recherche_semantique(question, top_k=top_k)
-        historique.insert(0, {
+        noter_premiere_requete(resultat["temps_ms"])
+        ajouter_historique({
             "question":  question,
             "score_top": resultat["resultats"][0]["score"] if resultat["resultats"] else 0,
             "temps_ms":  resultat["temps_ms"],
         })
-        if len(historique) > 30:
-            historique.pop()
         return jsonify(resultat)
     except Exception as e:
         return jsonify({"erreur": str(e)}), 500
@@ -315,6 +637,11 @@ def get_historique():
     return jsonify(historique)
 
 
+@app.route("/sante")
+def sante():
+    return jsonify(_warmup), (200 if _warmup["pret"] else 503)
+
+
 @app.route("/export/csv", methods=["POST"])
 def export_csv():
     data = request.get_json()
@@ -323,7 +650,7 @@ def export_csv():
     writer = csv.writer(output)
     writer.writerow(["Rang", "Score", "Document", "Texte", "Mots-cles"])
     for r in resultats:
-        writer.writerow([r["rang"], r["score"], r.get("document",""), r["texte"], ", ".join(r.get("mots_cles",[]))])
+        writer.writerow([r["rang"], r["score"], " | ".join(r.get("documents") or [r.get("document","")]), r["texte"], ", ".join(r.get("mots_cles",[]))])
     return Response(
         output.getvalue(),
         mimetype="text/csv",
@@ -341,6 +668,82 @@ def export_json():
     )
 
 
+@app.route("/export/stream/csv", methods=["GET", "POST"])
+def export_stream_csv():
+    questions, top_k, index, erreur = preparer_export()
+    if erreur:
+        return erreur
+
+    def generer():
+        tampon = io.StringIO()
+        writer = csv.writer(tampon)
+        writer.writerow(["Question", "Rang", "Score", "Document", "Texte", "Mots-cles"])
+        for r in generer_lignes_export(index, questions, top_k):
+            writer.writerow([r["question"], r["rang"], r["score"], " | ".join(r["documents"]), r["texte"], ", ".join(r["mots_cles"])])
+            yield tampon.getvalue()
+            tampon.seek(0)
+            tampon.truncate(0)
+        yield tampon.getvalue()
+
+    return Response(
+        stream_with_context(generer()),
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment; filename=export_rag.csv"}
+    )
+
+
+@app.route("/export/stream/jsonl", methods=["GET", "POST"])
+def export_stream_jsonl():
+    questions, top_k, index, erreur = preparer_export()
+    if erreur:
+        return erreur
+
+    def generer():
+        for r in generer_lignes_export(index, questions, top_k):
+            yield json.dumps(r, ensure_ascii=False) + "\n"
+
+    return Response(
+        stream_with_context(generer()),
+        mimetype="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=export_rag.jsonl"}
+    )
+
+
+def _prechauffer_en_arriere_plan():
+    """
+    Reessaie avec un delai croissant (la base demarre souvent apres l'app).
+    Apres WARMUP_TENTATIVES echecs, l'instance est declaree prete sans
+    prechauffage : l'index sera charge a la premiere recherche, et l'erreur
+    reste visible sur /sante.
+    """
+    delai = 1
+    for tentative in range(1, WARMUP_TENTATIVES + 1):
+        try:
+            prechauffer()
+            _warmup.pop("erreur", None)
+            return
+        except Exception as e:
+            print(f"Prechauffage impossible (tentative {tentative}/{WARMUP_TENTATIVES}) : {e}")
+            _warmup["erreur"] = str(e)
+            if tentative < WARMUP_TENTATIVES:
+                time.sleep(delai)
+                delai = min(delai * 2, 30)
+    print("Prechauffage abandonne : chargement paresseux a la premiere recherche.")
+    _warmup["pret"] = True
+
+
+charger_historique()
+atexit.register(sauvegarder_historique)
+
+# Sous le reloader de app.run(debug=True), seul le processus enfant
+# (WERKZEUG_RUN_MAIN) sert les requetes : le parent ne prechauffe pas.
+if __name__ != "__main__" or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    if WARMUP_ENABLED:
+        threading.Thread(target=_prechauffer_en_arriere_plan, daemon=True).start()
+    else:
+        _warmup["pret"] = True
+
+
 if __name__ == "__main__":
     print("\nPrototype RAG demarre sur http://localhost:5000\n")
     app.run(debug=True, port=5000)
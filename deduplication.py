@@ -0,0 +1,40 @@
+"""
+=============================================================
+  OUTILS DE DÉDUPLICATION DES FRAGMENTS
+  Partagés par 01_ingestion.py (index dédupliqué) et app.py
+  (fusion des doublons d'un index construit avant la déduplication)
+=============================================================
+"""
+
+import re
+import hashlib
+
+
+def normaliser_texte(texte: str) -> str:
+    """Texte en minuscules, espaces et sauts de ligne réduits à un espace."""
+    return re.sub(r'\s+', ' ', texte.lower()).strip()
+
+
+def empreinte(texte: str) -> str:
+    """Hash du texte normalisé, pour repérer les doublons exacts."""
+    return hashlib.sha1(normaliser_texte(texte).encode("utf-8")).hexdigest()
+
+
+def shingles(texte: str, k: int = 3) -> set[tuple[str, ...]]:
+    """Ensemble des suites de k mots consécutifs du texte normalisé."""
+    mots = re.findall(r'\w+', normaliser_texte(texte))
+    if len(mots) < k:
+        return {tuple(mots)}
+    return {tuple(mots[i:i + k]) for i in range(len(mots) - k + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    """Similarité de Jaccard entre deux ensembles de shingles."""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def valeurs_numeriques(texte: str) -> set[str]:
+    """Nombres du texte (dosages, activités, références produit comme MAX63)."""
+    return set(re.findall(r'\d+(?:[.,]\d+)?', texte))
@@ -14,8 +14,12 @@ CREATE TABLE IF NOT EXISTS embeddings (
     id             SERIAL PRIMARY KEY,
     id_document    INT,
     texte_fragment TEXT,
-    vecteur        TEXT    -- stocké comme JSON : "[0.1, 0.2, ...]"
+    vecteur        TEXT,   -- stocké comme JSON : "[0.1, 0.2, ...]"
+    documents      TEXT    -- documents sources du fragment dédupliqué : "[1, 5, 12]"
 );
 
+-- Base existante : ajouter la colonne des sources
+ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS documents TEXT;
+
 -- Vérification
 SELECT COUNT(*) AS total_fragments FROM embeddings;